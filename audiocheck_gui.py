@@ -2,12 +2,17 @@ import streamlit as st
 import pandas as pd
 import os
 import glob
-import difflib
+import collections
+import json
+import mimetypes
+import queue
 import threading
 import time
 import signal
 import streamlit.components.v1 as components
-from audiocheck_transcriber import transcribe_and_compare
+from streamlit.runtime import get_instance
+from audiocheck_transcriber import (transcribe_and_compare, similarity, similarity_scores, load_whisper_model,
+                                    file_signature, write_feather_snapshot, read_feather_snapshot)
 import numpy as np
 
 # --- Keyboard Shortcuts Logic ---
@@ -49,30 +54,105 @@ def inject_keyboard_shortcuts():
 
 # --- Automatic Shutdown Logic ---
 # This stops the server when no browser tabs are active
-def monitor_sessions():
-    time.sleep(10) # Initial grace period for startup
+@st.cache_resource
+def get_shutdown_event():
+    # One per server process, so the Shut Down button can wake the monitor from any rerun
+    return threading.Event()
+
+@st.cache_resource
+def get_wake_event():
+    # Set whenever a browser session goes away (or on Shut Down) to wake the monitor
+    return threading.Event()
+
+@st.cache_resource
+def get_data_dirs():
+    # Data directories any session has opened, so edit logs can be compacted at shutdown
+    return set()
+
+def hook_session_disconnects(rt, wake):
+    # Streamlit calls this internal handler when a tab disconnects or a session closes.
+    # Returns False if it isn't there, in which case the monitor falls back to polling.
+    original = getattr(rt, "_on_session_disconnected", None)
+    if original is None:
+        return False
+    def on_session_disconnected():
+        original()
+        wake.set()
+    rt._on_session_disconnected = on_session_disconnected
+    return True
+
+def monitor_sessions(stop, wake, data_dirs):
+    if stop.wait(10): # Initial grace period for startup
+        return
+    hooked = False
     while True:
         try:
-            from streamlit.runtime import get_instance
             rt = get_instance()
             if rt:
+                if not hooked:
+                    hooked = hook_session_disconnects(rt, wake)
                 sessions = rt._session_mgr.list_active_sessions()
                 if len(sessions) == 0:
                     # Grace period for refreshes/switching tabs
-                    time.sleep(15) 
+                    if stop.wait(15):
+                        return
                     sessions = rt._session_mgr.list_active_sessions()
                     if len(sessions) == 0:
+                        flush_pending_writes()
+                        # No session is left to save its edits, so fold every log in now
+                        compact_edit_logs(data_dirs)
                         os.kill(os.getpid(), signal.SIGINT)
         except Exception:
             pass
-        time.sleep(10)
+        # Sleep until a session disconnects; only poll if the hook couldn't be installed
+        wake.wait(None if hooked else 30)
+        wake.clear()
+        if stop.is_set():
+            return
 
 if "monitor_thread_started" not in st.session_state:
     # Use a global-ish check to avoid multiple threads across reruns
     if not any(t.name == "ShutdownMonitor" for t in threading.enumerate()):
-        threading.Thread(target=monitor_sessions, name="ShutdownMonitor", daemon=True).start()
+        threading.Thread(target=monitor_sessions, args=(get_shutdown_event(), get_wake_event(), get_data_dirs()),
+                         name="ShutdownMonitor", daemon=True).start()
     st.session_state.monitor_thread_started = True
 
+# --- Background CSV Writer ---
+# Folding edits into the CSV rewrites the whole file, so it happens off the script thread
+WRITE_DELAY = 0.75 # Seconds to wait for further saves of the same file
+
+@st.cache_resource
+def get_csv_writer():
+    # One queue and writer thread per server process
+    jobs = queue.Queue()
+    threading.Thread(target=write_csv_jobs, args=(jobs,), name="CsvWriter", daemon=True).start()
+    return jobs
+
+def write_csv_jobs(jobs):
+    while True:
+        batch = [jobs.get()]
+        time.sleep(WRITE_DELAY)
+        while True:
+            try:
+                batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        # Only the newest snapshot of each file needs writing
+        latest = {}
+        for path, df, seq in batch:
+            latest[path] = (df, seq)
+        for path, (df, seq) in latest.items():
+            try:
+                write_csv(df, path, seq)
+            except Exception as e:
+                print(f"Error saving {path}: {e}")
+        for _ in batch:
+            jobs.task_done()
+
+def flush_pending_writes():
+    # Block until every queued save is on disk
+    get_csv_writer().join()
+
 # Set page title and layout
 st.set_page_config(page_title="AudioCheck", layout="wide")
 
@@ -80,45 +160,371 @@ st.set_page_config(page_title="AudioCheck", layout="wide")
 inject_keyboard_shortcuts()
 
 def get_participants(data_dir="data"):
-    if not os.path.exists(data_dir):
+    if not os.path.isdir(data_dir):
         return []
+    # Adding or removing a folder bumps the directory's mtime, which re-keys the listing
+    return _participants_cached(data_dir, os.stat(data_dir).st_mtime_ns)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _participants_cached(data_dir, mtime_ns):
     # Find folders that look like participant IDs (digits)
-    return sorted([d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)) and d.isdigit()])
+    # scandir's DirEntry.is_dir() avoids a separate stat() per entry
+    with os.scandir(data_dir) as entries:
+        return sorted(e.name for e in entries if e.is_dir() and e.name.isdigit())
+
+def build_audio_index(base_dir, pid):
+    # Walk the participant folder once per load; path lookups then hit this set instead
+    # of the disk. Not cached across loads, so files added or renamed since are found
+    index = set()
+    for root, _, files in os.walk(os.path.join(base_dir, str(pid))):
+        for f in files:
+            index.add(os.path.abspath(os.path.join(root, f)))
+    return index
+
+@st.cache_resource(show_spinner=False)
+def get_whisper_model(name="base"):
+    # Loaded once per server process instead of on every transcription run.
+    # By default torch takes every core, which starves the server thread (the UI
+    # stops responding during a run); half the cores keeps the model busy
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # Only allowed before torch's first parallel work (already set)
+    return load_whisper_model(name)
+
+@st.cache_resource
+def get_transcription_lock():
+    # The cached model is shared by every session and its decoder is not thread-safe
+    return threading.Lock()
+
+LOG_INTERVAL = 0.5 # Seconds between progress log redraws
+
+def run_transcription(participant_id, log_container):
+    # Keep the latest lines and redraw at most every LOG_INTERVAL, not once per message
+    lines = collections.deque(maxlen=20)
+    last_draw = 0.0
+    def update_status(msg):
+        nonlocal last_draw
+        lines.append(msg)
+        now = time.monotonic()
+        if now - last_draw >= LOG_INTERVAL:
+            log_container.code("\n".join(lines))
+            last_draw = now
+
+    lock = get_transcription_lock()
+    if not lock.acquire(blocking=False):
+        log_container.info("Waiting for another transcription to finish...")
+        lock.acquire()
+    try:
+        flush_pending_writes() # Don't let a queued save overwrite the new results
+        # The model is only loaded once the transcriber has checked its inputs
+        success = transcribe_and_compare(participant_id, data_dir=st.session_state.data_dir,
+                                         status_callback=update_status, load_model=get_whisper_model)
+    finally:
+        lock.release()
+    log_container.code("\n".join(lines)) # Final state, including the last messages
+    return success
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _load_cached(csv_path, signature):
+    # The CSV's (mtime_ns, size) is part of the cache key so any write to it invalidates it
+    return read_results(csv_path, signature)
+
+def read_results(csv_path, signature=None):
+    # Results table with the GUI's columns ensured (no edits applied)
+    if signature is None:
+        signature = file_signature(csv_path)
+    # Typed already, so no parsing is needed (the transcriber writes one too); only
+    # used if it was written for exactly this CSV, so a restored older CSV still wins
+    df = read_feather_snapshot(csv_path, signature)
+
+    from_csv = df is None
+    if from_csv:
+        # The pyarrow parser is multithreaded; dtypes stay NumPy-backed so in-place edits keep working
+        df = pd.read_csv(csv_path, engine='pyarrow')
+    columns_before = list(df.columns)
+
+    # Ensure the review flag columns exist and are boolean, in one pass (blanks count as False)
+    flags = ['manual_correct', 'manual_reviewed']
+    df[flags] = df.reindex(columns=flags).fillna(False).astype(bool)
+
+    # Results from older transcriber versions lack original_transcription (change tracking).
+    # Copy-on-write makes this a reference until edited; the snapshot below then keeps
+    # it, and the next CSV save persists it
+    if 'original_transcription' not in df.columns:
+        df['original_transcription'] = df['transcribed_text']
+
+    # Score rows that have no similarity yet (e.g. hand-made or externally edited CSVs)
+    if 'similarity_score' not in df.columns:
+        df['similarity_score'] = np.nan
+    missing = df['similarity_score'].isna()
+    if missing.any():
+        df.loc[missing, 'similarity_score'] = rescore_all(df[missing])
+
+    # Snapshots from the GUI come back unchanged; fresh ones from the transcriber gain columns
+    if from_csv or list(df.columns) != columns_before:
+        write_snapshot(df, csv_path)
+    return df
+
+def write_snapshot(df, csv_path):
+    # Typed binary copy of the results CSV; the CSV stays the file people open
+    try:
+        write_feather_snapshot(df, csv_path)
+    except Exception:
+        pass # Only a load-time shortcut, the CSV has everything
+
+def rescore_all(df):
+    # The transcriber's scoring rule, over every row at once
+    return similarity_scores(df['transcribed_text'].fillna('').astype(str).tolist(),
+                             df['target_phrase'].fillna('').astype(str).tolist())
 
 def load_data(participant_id, data_dir="data"):
+    flush_pending_writes() # A queued save may be about to replace this CSV
     p_dir = os.path.join(data_dir, str(participant_id))
     csv_path = os.path.join(p_dir, f"{participant_id}_transcription_results.csv")
     
     if not os.path.exists(csv_path):
         return None, None
 
-    df = pd.read_csv(csv_path)
-    
-    # Ensure manual_correct column exists
-    if 'manual_correct' not in df.columns:
-        df['manual_correct'] = False
-    
-    # Ensure manual_correct is boolean
-    df['manual_correct'] = df['manual_correct'].fillna(False).astype(bool)
-
-    # Ensure manual_reviewed column exists
-    if 'manual_reviewed' not in df.columns:
-        df['manual_reviewed'] = False
-    
-    # Ensure manual_reviewed is boolean
-    df['manual_reviewed'] = df['manual_reviewed'].fillna(False).astype(bool)
-
-    # Ensure original_transcription column exists (for change tracking)
-    if 'original_transcription' not in df.columns:
-        df['original_transcription'] = df['transcribed_text']
-
+    df = _load_cached(csv_path, tuple(file_signature(csv_path)))
+    # Apply edits made since the CSV was last written
+    df = replay_edits(df, csv_path)
     return df, csv_path
 
+def get_edits_path(csv_path):
+    # Sidecar log next to the results CSV, e.g. data/101/101_edits.jsonl
+    pid = os.path.basename(csv_path).replace("_transcription_results.csv", "")
+    return os.path.join(os.path.dirname(csv_path), f"{pid}_edits.jsonl")
+
+def build_trial_keys(df):
+    # Row identity for the edit log, independent of row order in the CSV. Rows can
+    # share block/trial/file (e.g. blank rows), so repeats are numbered in file order
+    seen = collections.Counter()
+    keys = []
+    for block, trial, filename in zip(df['block'].to_numpy(), df['trial'].to_numpy(),
+                                      df['audio_filename'].to_numpy()):
+        key = f"{block}|{trial}|{filename}"
+        keys.append(f"{key}#{seen[key]}")
+        seen[key] += 1
+    return keys
+
+def append_edits(path, edits, base):
+    # One JSON line per edit, so autosave cost does not grow with the CSV.
+    # base is the signature of the CSV the edits apply on top of
+    lines = []
+    for key, field, value, ts in edits:
+        if hasattr(value, 'item'):
+            value = value.item() # numpy scalars are not JSON serializable
+        lines.append(json.dumps({"trial": key, "field": field, "value": value, "ts": ts, "base": base}) + "\n")
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write("".join(lines))
+
+def flush_edits():
+    # Write the edits recorded by callbacks since the last flush with a single append
+    pending = st.session_state.get('pending_edits')
+    if pending:
+        flush_pending_writes() # After a save, the edits sit on top of the CSV being written
+        append_edits(st.session_state.edits_path, pending, file_signature(st.session_state.csv_path))
+        st.session_state.pending_edits = []
+
+def get_queued_edits_paths(edits_path):
+    # Logs set aside by save_data, oldest first; removed once their CSV write lands
+    paths = [p for p in glob.glob(glob.escape(edits_path) + ".*") if p.rsplit(".", 1)[1].isdigit()]
+    return sorted(paths, key=lambda p: int(p.rsplit(".", 1)[1]))
+
+def replay_edits(df, csv_path):
+    path = get_edits_path(csv_path)
+    paths = [p for p in get_queued_edits_paths(path) + [path] if os.path.exists(p)]
+    if not paths:
+        return df
+
+    # Only edits made on top of the CSV as it is now apply; anything else was
+    # superseded by a rewrite (e.g. a CLI transcription run or an external edit)
+    base = file_signature(csv_path)
+    records = []
+    for p in paths:
+        stale = True
+        with open(p, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Partially written line (e.g. crash mid-append)
+                if record.get('base') == base and 'trial' in record:
+                    records.append(record)
+                    stale = False
+        if stale:
+            os.remove(p)
+    if not records:
+        return df
+
+    # Last write wins per cell, then apply one vectorized assignment per column
+    edits = pd.DataFrame.from_records(records).drop_duplicates(['trial', 'field'], keep='last')
+    index_of = dict(zip(build_trial_keys(df), df.index))
+    edits['index'] = edits['trial'].map(index_of)
+    edits = edits[edits['index'].notna() & edits['field'].isin(df.columns)]
+    for field, group in edits.groupby('field'):
+        df.loc[group['index'].to_numpy(), field] = group['value'].infer_objects().to_numpy()
+    return df
+
+def autosave(idx, **fields):
+    # Update the in-memory DataFrame and record each change for the sidecar
+    df = st.session_state.data
+    pos = df.index.get_loc(idx) # Resolve the label once, then write positionally
+    for field, value in fields.items():
+        df.iat[pos, df.columns.get_loc(field)] = value
+        # Recorded now, written once per run by flush_edits
+        st.session_state.setdefault('pending_edits', []).append(
+            (st.session_state.trial_keys[pos], field, value, time.time()))
+    # Only this row's navigation label can have changed
+    st.session_state.trial_labels.update(build_trial_labels(st.session_state.data.loc[[idx]]))
+    # Sort position depends on the reviewed flag; membership on the filter mask
+    queue_changed = 'manual_reviewed' in fields
+    if 'filter_key' in st.session_state:
+        mask = st.session_state.filter_mask
+        was_shown = mask.at[idx]
+        mask.loc[[idx]] = build_filter_mask(st.session_state.data.loc[[idx]], *st.session_state.filter_key)
+        queue_changed |= mask.at[idx] != was_shown
+    if queue_changed:
+        st.session_state.pop('order_key', None)
+        st.session_state.queue_changed = True # The edit panel reruns the whole app
+    # Shown by the edit panel; elements can't be drawn from a fragment's callback
+    st.session_state.show_saved_toast = True
+
+def build_trial_labels(df):
+    # Icons: 🔵 = Corrected, ✅ = Reviewed, ⚠️ = Low confidence, ✔️ = High confidence
+    status = np.select(
+        [df['manual_reviewed'].to_numpy(dtype=bool),
+         df['manual_correct'].to_numpy(dtype=bool),
+         df['similarity_score'].to_numpy() < 0.8],
+        ["✅", "🔵", "⚠️"],
+        default="✔️"
+    )
+    # Plain dict of index -> label; f-strings on the column arrays, no per-row Series
+    return {idx: f"{icon} B{block} T{trial} ({score:.2f})"
+            for idx, icon, block, trial, score in zip(df.index, status, df['block'].to_numpy(),
+                                                      df['trial'].to_numpy(), df['similarity_score'].to_numpy())}
+
+def sort_codes(values):
+    # Rank of each value with blanks last, so text labels with empty cells sort too
+    # (comparing str and NaN directly raises TypeError)
+    codes, uniques = pd.factorize(values, sort=True)
+    return np.where(codes < 0, len(uniques), codes)
+
+def build_filter_mask(df, threshold, hide_reviewed):
+    # threshold=None means the similarity filter is off
+    mask = np.ones(len(df), dtype=bool)
+    if threshold is not None:
+        # Important: Let corrected/reviewed items stay even if they now have high scores
+        mask &= (df['similarity_score'].to_numpy() < threshold) | df['manual_correct'].to_numpy() | df['manual_reviewed'].to_numpy()
+
+    if hide_reviewed:
+        # Explicitly remove finished items if requested
+        mask &= ~df['manual_reviewed'].to_numpy()
+    return pd.Series(mask, index=df.index)
+
 def save_data(df, path):
-    df.to_csv(path, index=False)
+    # Set the edit log aside so new edits start a fresh one, then queue the CSV write
+    seq = time.time_ns()
+    edits_path = get_edits_path(path)
+    if os.path.exists(edits_path):
+        os.replace(edits_path, f"{edits_path}.{seq}")
+    get_csv_writer().put((path, df.copy(), seq))
     # Silent save or subtle toast
     st.toast(f"Saved changes to {os.path.basename(path)}", icon="💾")
 
+def write_csv(df, path, seq=None):
+    # Runs on the writer thread: atomic replace, then drop the logs this snapshot contains
+    # (seq=None: every log, including the live one)
+    tmp_path = path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    write_snapshot(df, path)
+    edits_path = get_edits_path(path)
+    for p in get_queued_edits_paths(edits_path):
+        if seq is None or int(p.rsplit(".", 1)[1]) <= seq:
+            os.remove(p)
+    if seq is None and os.path.exists(edits_path):
+        os.remove(edits_path)
+
+def compact_edit_logs(data_dirs):
+    # Session-independent save: replay each participant's edit logs into their CSV
+    for data_dir in list(data_dirs):
+        logs = glob.glob(os.path.join(glob.escape(data_dir), "*", "*_edits.jsonl*"))
+        for prefix in {p[:p.rindex("_edits.jsonl")] for p in logs}:
+            csv_path = prefix + "_transcription_results.csv"
+            if not os.path.exists(csv_path):
+                continue
+            try:
+                df = replay_edits(read_results(csv_path), csv_path)
+                edits_path = get_edits_path(csv_path)
+                # Logs left over from an older CSV are dropped by the replay
+                if os.path.exists(edits_path) or get_queued_edits_paths(edits_path):
+                    write_csv(df, csv_path)
+            except Exception as e:
+                print(f"Error saving {csv_path}: {e}")
+
+def discard_edits():
+    # Fresh transcription results replace the rows the edits refer to; the
+    # transcriber already removed the logs on disk
+    st.session_state.pop('pending_edits', None)
+    st.session_state.pop('data', None)
+
+def compact_pending_edits():
+    # Write the current participant's edits into their CSV, if there are any
+    if 'data' not in st.session_state:
+        return
+    flush_edits()
+    if os.path.exists(st.session_state.edits_path):
+        save_data(st.session_state.data, st.session_state.csv_path)
+
+def resolve_audio_paths(df, base_dir, pid):
+    # Resolved once per participant load (one lookup per distinct filename), so reruns
+    # just index this Series; None where no file was found
+    filenames = df['audio_filename'].fillna('').astype(str)
+    index = build_audio_index(base_dir, pid)
+    resolved = {f: _resolve_audio_path(base_dir, pid, f, index) for f in filenames.unique()}
+    return pd.Series([resolved[f] for f in filenames], index=df.index, dtype=object)
+
+def _resolve_audio_path(base_dir, pid, filename, index):
+    # Normalize separators
+    filename = filename.replace('\\', '/')
+    
+    candidates = []
+    
+    # 1. As absolute path or relative to current working directory
+    candidates.append(filename)
+    
+    # 2. Relative to the participant directory inside base_dir
+    # e.g. base_dir/1/audio/trial_1.wav
+    # This works if filename is just "audio/trial_1.wav"
+    candidates.append(os.path.join(base_dir, str(pid), filename))
+    
+    # 3. Handle case where filename includes "data/{pid}/" prefix
+    if filename.startswith(f"data/{pid}/"):
+        stripped = filename.replace(f"data/{pid}/", "", 1)
+        candidates.append(os.path.join(base_dir, str(pid), stripped))
+        
+    # 4. Handle generic "data/" prefix if base_dir ends with "data"
+    if filename.startswith("data/") and base_dir.rstrip('/').endswith("data"):
+        parent = os.path.dirname(base_dir.rstrip('/'))
+        candidates.append(os.path.join(parent, filename))
+
+    # Fast path: check all candidates against the participant's file index
+    for c in candidates:
+        if os.path.abspath(c) in index:
+            return c
+
+    # The index misses symlinked folders, paths outside the participant folder and
+    # case differences on case-insensitive disks, so probe the disk as well
+    for c in candidates:
+        if os.path.exists(c):
+            return c
+            
+    return None
+
 # --- Sidebar ---
 st.sidebar.title("AudioCheck")
 
@@ -126,11 +532,15 @@ st.sidebar.title("AudioCheck")
 # Priority: 1. Session State (if set and valid) -> 2. ./data -> 3. ../data
 found_data_dir = None
 
-possible_dirs = ["data", "../data", "../Adp1/data", "../ADP1/data"]
-for d in possible_dirs:
-    if os.path.exists(d) and os.path.isdir(d):
-        found_data_dir = d
-        break
+if 'data_dir' in st.session_state and os.path.isdir(st.session_state.data_dir):
+    # Already resolved on an earlier run; skip probing the candidates
+    found_data_dir = st.session_state.data_dir
+else:
+    possible_dirs = ["data", "../data", "../Adp1/data", "../ADP1/data"]
+    for d in possible_dirs:
+        if os.path.isdir(d): # isdir is False for missing paths too
+            found_data_dir = d
+            break
 
 if not found_data_dir:
     st.error("### ⚠️ Data Folder Not Found")
@@ -146,6 +556,7 @@ if not found_data_dir:
 
 # Set the valid data dir
 st.session_state.data_dir = found_data_dir
+get_data_dirs().add(os.path.abspath(found_data_dir))
     
 # Participant Selection
 participants = get_participants(st.session_state.data_dir)
@@ -166,13 +577,12 @@ if not data_exists:
         with st.spinner(f"Transcribing audio for Participant {selected_pid}... (This may take a while)"):
             # Progress container
             log_container = st.sidebar.empty()
-            def update_status(msg):
-                log_container.text(msg)
             
-            # Pass the custom data directory
-            success = transcribe_and_compare(selected_pid, data_dir=st.session_state.data_dir, status_callback=update_status)
+            # Uses the resolved data directory and the cached Whisper model
+            success = run_transcription(selected_pid, log_container)
             
             if success:
+                discard_edits()
                 st.sidebar.success("Transcription complete!")
                 st.rerun()
             else:
@@ -184,20 +594,28 @@ st.sidebar.markdown("---")
 if st.sidebar.button("Re-run Transcription"):
     with st.spinner(f"Re-transcribing Participant {selected_pid}..."):
         log_container = st.sidebar.empty()
-        def update_status(msg):
-            log_container.text(msg)
-        success = transcribe_and_compare(selected_pid, data_dir=st.session_state.data_dir, status_callback=update_status)
+        success = run_transcription(selected_pid, log_container)
         if success:
+            discard_edits()
             st.sidebar.success("Done!")
             st.rerun()
 
 # --- Load Data & Review Interface ---
 # Reload if PID changes or data not in state
 if 'data' not in st.session_state or st.session_state.get('current_pid') != selected_pid:
+    # Fold the previous participant's edits into their CSV before switching
+    compact_pending_edits()
     df, csv_path = load_data(selected_pid, data_dir=st.session_state.data_dir)
     if df is not None:
         st.session_state.data = df
         st.session_state.csv_path = csv_path
+        st.session_state.edits_path = get_edits_path(csv_path)
+        st.session_state.trial_labels = build_trial_labels(df)
+        st.session_state.trial_keys = build_trial_keys(df)
+        st.session_state.audio_paths = resolve_audio_paths(df, st.session_state.data_dir, selected_pid)
+        st.session_state.pop('filter_key', None)
+        st.session_state.pop('order_key', None)
+        st.session_state.pop('editor_trial', None)
         st.session_state.current_pid = selected_pid
     else:
         st.error("Error loading data.")
@@ -216,37 +634,32 @@ sort_priority = st.sidebar.checkbox("Sort: Unreviewed First", value=True)
 
 
 # Filter logic
-mask = pd.Series(True, index=df.index)
-if show_low_conf:
-    threshold = st.sidebar.slider("Confidence Threshold", 0.0, 1.0, 1.0, 0.05)
-    # Important: Let corrected/reviewed items stay even if they now have high scores
-    mask &= (df['similarity_score'] < threshold) | (df['manual_correct']) | (df['manual_reviewed'])
+threshold = st.sidebar.slider("Confidence Threshold", 0.0, 1.0, 1.0, 0.05) if show_low_conf else None
 
-if hide_reviewed:
-    # Explicitly remove finished items if requested
-    mask &= (~df['manual_reviewed'])
-
-filtered_df = df[mask].copy()
+# Recompute only when the filter settings change; autosave patches edited rows
+filter_key = (threshold, hide_reviewed)
+if st.session_state.get('filter_key') != filter_key:
+    st.session_state.filter_mask = build_filter_mask(df, *filter_key)
+    st.session_state.filter_key = filter_key
+mask = st.session_state.filter_mask
 
 # Navigation List & Sorting
-def get_trial_label(row):
-    # Icons: 🔵 = Corrected, ✅ = Reviewed, ⚠️ = Low confidence, ✔️ = High confidence
-    if row.get('manual_reviewed'):
-        status = "✅"
-    elif row.get('manual_correct'):
-        status = "🔵"
-    else:
-        status = "⚠️" if row['similarity_score'] < 0.8 else "✔️"
-    return f"{status} B{row['block']} T{row['trial']} ({row['similarity_score']:.2f})"
-
-# Sorting Logic
-if sort_priority:
-    # Unreviewed first (manual_reviewed=0), then Block/Trial
-    filtered_df['sort_reviewed'] = filtered_df['manual_reviewed'].astype(int)
-    filtered_indices = filtered_df.sort_values(['sort_reviewed', 'block', 'trial']).index.tolist()
-else:
-    # Natural order (Block/Trial)
-    filtered_indices = filtered_df.sort_values(['block', 'trial']).index.tolist()
+# Reused until the filter/sort settings change or an edit can move a row (see autosave)
+order_key = (filter_key, sort_priority)
+if st.session_state.get('order_key') != order_key:
+    # np.lexsort sorts by its last key first, straight from the column arrays
+    keep = mask.to_numpy()
+    sort_keys = [sort_codes(df['trial'].to_numpy()[keep]), sort_codes(df['block'].to_numpy()[keep])]
+    if sort_priority:
+        # Unreviewed first (manual_reviewed=0), then Block/Trial
+        sort_keys.append(df['manual_reviewed'].to_numpy()[keep].astype(np.int8))
+    # Otherwise natural order (Block/Trial)
+    st.session_state.filtered_indices = df.index.to_numpy()[keep][np.lexsort(sort_keys)].tolist()
+    # Position of each trial in the queue, so lookups don't scan the list
+    st.session_state.queue_pos = {idx: i for i, idx in enumerate(st.session_state.filtered_indices)}
+    st.session_state.order_key = order_key
+filtered_indices = st.session_state.filtered_indices
+pos_of = st.session_state.queue_pos
 
 st.sidebar.write(f"Showing {len(filtered_indices)} / {len(df)} trials")
 
@@ -257,12 +670,12 @@ if not filtered_indices:
     st.stop()
 
 # --- Selection Logic with Persistence ---
-if 'current_trial_idx' not in st.session_state or st.session_state.current_trial_idx not in filtered_indices:
+if 'current_trial_idx' not in st.session_state or st.session_state.current_trial_idx not in pos_of:
     st.session_state.current_trial_idx = filtered_indices[0]
 
 # Sidebar Navigation Buttons
 col_prev, col_next = st.sidebar.columns(2)
-curr_pos = filtered_indices.index(st.session_state.current_trial_idx)
+curr_pos = pos_of[st.session_state.current_trial_idx]
 
 # Sync the selectbox key with the current_trial_idx before rendering
 st.session_state.temp_selectbox = st.session_state.current_trial_idx
@@ -278,11 +691,14 @@ if col_next.button("Next ➡️", use_container_width=True, disabled=(curr_pos =
 def on_selectbox_change():
     st.session_state.current_trial_idx = st.session_state.temp_selectbox
 
+# Labels are precomputed per participant and patched by autosave
+trial_labels = st.session_state.trial_labels
+
 # Removed 'index' because it's now handled by the state sync above
 selected_index = st.sidebar.selectbox(
     "Select Trial", 
     filtered_indices, 
-    format_func=lambda i: get_trial_label(df.loc[i]),
+    format_func=trial_labels.get,
     key="temp_selectbox",
     on_change=on_selectbox_change
 )
@@ -290,150 +706,149 @@ selected_index = st.sidebar.selectbox(
 # --- Main Content ---
 row = df.loc[selected_index]
 
-# Header
-col1, col2 = st.columns([3, 1])
-with col1:
-    st.subheader(f"Block {row['block']}, Trial {row['trial']}")
-with col2:
-    val = row['similarity_score']
-    color = "normal" if val == 1.0 else ("inverse" if val < 0.8 else "off")
-    st.metric("Similarity", f"{val:.2f}", delta_color=color)
-
-# Comparison Card
-st.markdown("---")
-c1, c2 = st.columns(2)
-with c1:
-    st.markdown("**Target Phrase**")
-    st.info(f"### {row['target_phrase']}")
-
-with c2:
-    st.markdown("**Transcribed Text**")
+@st.fragment
+def edit_panel(selected_index, filtered_indices, pos_of):
+    # Edits here rerun only this panel instead of the whole app
+    row = st.session_state.data.loc[selected_index]
+
+    # Header
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        st.subheader(f"Block {row['block']}, Trial {row['trial']}")
+    with col2:
+        val = row['similarity_score']
+        color = "normal" if val == 1.0 else ("inverse" if val < 0.8 else "off")
+        st.metric("Similarity", f"{val:.2f}", delta_color=color)
+
+    # Comparison Card
+    st.markdown("---")
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("**Target Phrase**")
+        st.info(f"### {row['target_phrase']}")
+
+    with c2:
+        st.markdown("**Transcribed Text**")
     
-    # Check if we have a valid string, handle NaN
-    current_text = row['transcribed_text']
-    original_text = row.get('original_transcription', current_text) # Fallback if missing
+        # Check if we have a valid string, handle NaN
+        current_text = row['transcribed_text']
+        original_text = row.get('original_transcription', current_text) # Fallback if missing
     
-    if pd.isna(current_text):
-        current_text = ""
-    if pd.isna(original_text):
-        original_text = ""
+        if pd.isna(current_text):
+            current_text = ""
+        if pd.isna(original_text):
+            original_text = ""
+
+        # The editor widgets keep stable keys across trials, so load this trial's
+        # values into them when the trial changes (or Streamlit dropped their state)
+        editor_values = {
+            "transcribe_editor": current_text,
+            "correct_editor": bool(row['manual_correct']),
+            "reviewed_editor": bool(row['manual_reviewed'])
+        }
+        if st.session_state.get('editor_trial') != selected_index or any(k not in st.session_state for k in editor_values):
+            for key, value in editor_values.items():
+                st.session_state[key] = value
+            st.session_state.editor_trial = selected_index
         
-    def update_transcription():
-        new_text = st.session_state[f"transcribe_{selected_index}"]
-        target = row['target_phrase']
+        target_phrase = row['target_phrase']
+        if pd.isna(target_phrase):
+            target_phrase = ""
+
+        def update_transcription():
+            new_text = st.session_state.transcribe_editor
         
-        # Calculate new similarity
-        if new_text and target:
-            t1 = new_text.lower().strip()
-            t2 = target.lower().strip()
-            new_score = difflib.SequenceMatcher(None, t1, t2).ratio()
-        else:
-            new_score = 0.0
+            # Calculate new similarity (memoized, so re-entering a text is free;
+            # similarity() normalizes both sides)
+            new_score = similarity(new_text or '', str(target_phrase))
             
-        # Update session state dataframe
-        st.session_state.data.at[selected_index, 'transcribed_text'] = new_text
-        st.session_state.data.at[selected_index, 'similarity_score'] = new_score
+            # Update session state dataframe and autosave
+            autosave(selected_index, transcribed_text=new_text, similarity_score=new_score)
         
-        # Autosave
-        save_data(st.session_state.data, st.session_state.csv_path)
-        
-    # Text Input for manual editing
-    st.text_input(
-        "Edit Transcription",
-        value=current_text,
-        key=f"transcribe_{selected_index}",
-        on_change=update_transcription,
-        label_visibility="collapsed"
-    )
+        # Text Input for manual editing
+        st.text_input(
+            "Edit Transcription",
+            key="transcribe_editor",
+            on_change=update_transcription,
+            label_visibility="collapsed"
+        )
 
-    def update_correct():
-        st.session_state.data.at[selected_index, 'manual_correct'] = st.session_state[f"correct_{selected_index}"]
-        save_data(st.session_state.data, st.session_state.csv_path)
+        def update_correct():
+            autosave(selected_index, manual_correct=st.session_state.correct_editor)
 
-    def update_reviewed():
-        new_val = st.session_state[f"reviewed_{selected_index}"]
-        st.session_state.data.at[selected_index, 'manual_reviewed'] = new_val
-        save_data(st.session_state.data, st.session_state.csv_path)
+        def update_reviewed():
+            new_val = st.session_state.reviewed_editor
+            autosave(selected_index, manual_reviewed=new_val)
         
-        # Auto-advance logic: Find the next NOT-YET-REVIEWED trial in the queue
-        if new_val:
-            try:
-                curr_idx_in_queue = filtered_indices.index(selected_index)
-                next_unreviewed = None
-                for i in range(curr_idx_in_queue + 1, len(filtered_indices)):
-                    candidate_id = filtered_indices[i]
-                    if not st.session_state.data.at[candidate_id, 'manual_reviewed']:
-                        next_unreviewed = candidate_id
-                        break
-                if next_unreviewed is not None:
-                    st.session_state.current_trial_idx = next_unreviewed
-            except (ValueError, IndexError):
-                pass
-
-    col_btn_1, col_btn_2 = st.columns(2)
-    with col_btn_1:
-        st.checkbox(
-            "Mark as Correct (🔵)", 
-            value=bool(row['manual_correct']),
-            key=f"correct_{selected_index}",
-            on_change=update_correct,
-            help="Indicates the transcription is accurate (Alt + C)"
-        )
-    with col_btn_2:
-        st.checkbox(
-            "Mark as Reviewed (✅)", 
-            value=bool(row['manual_reviewed']),
-            key=f"reviewed_{selected_index}",
-            on_change=update_reviewed,
-            help="Mark this trial finished and move to next (Alt + R)"
-        )
+            # Auto-advance logic: Find the next NOT-YET-REVIEWED trial in the queue
+            if new_val:
+                try:
+                    curr_idx_in_queue = pos_of[selected_index]
+                    next_unreviewed = None
+                    for i in range(curr_idx_in_queue + 1, len(filtered_indices)):
+                        candidate_id = filtered_indices[i]
+                        if not st.session_state.data.at[candidate_id, 'manual_reviewed']:
+                            next_unreviewed = candidate_id
+                            break
+                    if next_unreviewed is not None:
+                        st.session_state.current_trial_idx = next_unreviewed
+                except (KeyError, IndexError):
+                    pass
+
+        col_btn_1, col_btn_2 = st.columns(2)
+        with col_btn_1:
+            st.checkbox(
+                "Mark as Correct (🔵)", 
+                key="correct_editor",
+                on_change=update_correct,
+                help="Indicates the transcription is accurate (Alt + C)"
+            )
+        with col_btn_2:
+            st.checkbox(
+                "Mark as Reviewed (✅)", 
+                key="reviewed_editor",
+                on_change=update_reviewed,
+                help="Mark this trial finished and move to next (Alt + R)"
+            )
     
-    # Show change tracking if modified
-    if str(current_text) != str(original_text):
-        st.caption(f"Original: *{original_text}*")
+        # Show change tracking if modified
+        if str(current_text) != str(original_text):
+            st.caption(f"Original: *{original_text}*")
+
+    if st.session_state.pop('show_saved_toast', False):
+        st.toast("Saved", icon="💾")
 
+    # Auto-advance picked another trial, or the edit moved this one in or out of the
+    # queue, so the sidebar and previews have to follow; other edits stay in the panel
+    flush_edits()
+    queue_changed = st.session_state.pop('queue_changed', False)
+    if queue_changed or st.session_state.current_trial_idx != selected_index:
+        st.rerun(scope="app")
 
+edit_panel(selected_index, filtered_indices, pos_of)
 
 # Audio Player
 st.markdown("---")
 audio_filename = row['audio_filename']
 
-# Robust audio path finder
-def find_audio_path(base_dir, pid, filename):
-    # Normalize separators
-    filename = filename.replace('\\', '/')
-    
-    candidates = []
-    
-    # 1. As absolute path or relative to current working directory
-    candidates.append(filename)
-    
-    # 2. Relative to the participant directory inside base_dir
-    # e.g. base_dir/1/audio/trial_1.wav
-    # This works if filename is just "audio/trial_1.wav"
-    candidates.append(os.path.join(base_dir, str(pid), filename))
-    
-    # 3. Handle case where filename includes "data/{pid}/" prefix
-    if filename.startswith(f"data/{pid}/"):
-        stripped = filename.replace(f"data/{pid}/", "", 1)
-        candidates.append(os.path.join(base_dir, str(pid), stripped))
-        
-    # 4. Handle generic "data/" prefix if base_dir ends with "data"
-    if filename.startswith("data/") and base_dir.rstrip('/').endswith("data"):
-        parent = os.path.dirname(base_dir.rstrip('/'))
-        candidates.append(os.path.join(parent, filename))
-
-    # Check all candidates
-    for c in candidates:
-        if os.path.exists(c):
-            return c
-            
-    return None
-
-final_audio_path = find_audio_path(st.session_state.data_dir, selected_pid, audio_filename)
+# Audio player (paths were resolved at participant load)
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_audio_bytes(path, mtime):
+    # mtime in the key picks up re-recorded files; max_entries bounds memory
+    with open(path, 'rb') as f:
+        return f.read()
 
+final_audio_path = st.session_state.audio_paths.at[selected_index]
+audio_bytes = None
 if final_audio_path:
-    st.audio(final_audio_path)
+    try:
+        audio_bytes = load_audio_bytes(final_audio_path, os.path.getmtime(final_audio_path))
+    except OSError:
+        pass # Moved or deleted since the participant was loaded
+
+if audio_bytes is not None:
+    audio_format = mimetypes.guess_type(final_audio_path)[0] or "audio/wav"
+    st.audio(audio_bytes, format=audio_format)
 else:
     st.error(f"Audio file not found: {audio_filename}")
     st.markdown(f"**Search Debug:**\n- Data Dir: `{st.session_state.data_dir}`\n- Participant: `{selected_pid}`\n- Path in CSV: `{audio_filename}`")
@@ -445,7 +860,7 @@ st.markdown(f"### Data Preview (Focused)")
 
 # Calculate a window around the selected index to ensure it's visible
 try:
-    curr_preview_pos = filtered_indices.index(selected_index)
+    curr_preview_pos = pos_of[selected_index]
     total_filtered = len(filtered_indices)
     window_size = 7
     
@@ -465,22 +880,28 @@ try:
             start_win = total_filtered - window_size
             
         window_indices = filtered_indices[start_win:end_win]
-except (ValueError, IndexError):
+except (KeyError, IndexError):
     window_indices = filtered_indices[:7] # Fallback
 
-def highlight_selected(r):
-    return ['background-color: rgba(64, 128, 255, 0.2)' if r.name == selected_index else '' for _ in r]
+# Plain tables: a Styler would ship per-cell CSS to the browser on every rerun
+preview_config = {
+    "similarity_score": st.column_config.ProgressColumn("similarity_score", min_value=0.0, max_value=1.0, format="%.2f")
+}
 
+# The selected row is marked by a leading ▶ checkbox column instead of highlighting
+window = df.loc[window_indices]
 st.dataframe(
-    df.loc[window_indices].style.apply(highlight_selected, axis=1),
+    window.assign(_sel=window.index == selected_index),
     use_container_width=True,
-    hide_index=False
+    hide_index=False,
+    column_order=["_sel", *df.columns],
+    column_config={**preview_config, "_sel": st.column_config.CheckboxColumn("▶", width="small")}
 )
 
 # Full Data View
 st.markdown("---")
 with st.expander("📂 View Full Dataset (All Trials)"):
-    st.dataframe(df, use_container_width=True)
+    st.dataframe(df, use_container_width=True, column_config=preview_config)
 
 # Sidebar Footer (at the very bottom)
 st.sidebar.markdown("---")
@@ -493,8 +914,18 @@ with st.sidebar.expander("⌨️ Keyboard Shortcuts"):
     - **Enter**: (While editing) Save & Stay
     """)
 
+if st.sidebar.button("💾 Save to CSV", help="Write all edits into the results CSV now (also happens when switching participants or shutting down)."):
+    compact_pending_edits()
+
 if st.sidebar.button("🛑 Shut Down Server", help="Click here to completely stop the application and close the terminal."):
+    compact_pending_edits()
+    flush_pending_writes()
+    compact_edit_logs(get_data_dirs()) # Edits other tabs have not saved yet
     st.sidebar.warning("Shutting down... You can close this tab now.")
+    get_shutdown_event().set()
+    get_wake_event().set()
     time.sleep(1)
     os.kill(os.getpid(), signal.SIGINT)
 
+# Edits left over from a run that did not reach the edit panel
+flush_edits()
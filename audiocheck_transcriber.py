@@ -1,19 +1,317 @@
 import os
 import csv
-import difflib
+import glob
+import json
 import argparse
 import re
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
 
 
-def transcribe_and_compare(participant_id, data_dir="data", status_callback=None):
+# Keep ONLY word characters (letters, digits, underscore) and whitespace
+_PUNCT_RE = re.compile(r'[^\w\s]')
+# The same rule for ASCII text as a str.translate table (no regex engine per call)
+_ASCII_PUNCT = {c: None for c in range(128) if _PUNCT_RE.match(chr(c))}
+
+
+def strip_punctuation(text):
+    """Removes punctuation; handles unicode punctuation (curly quotes etc) by exclusion."""
+    if text.isascii():
+        return text.translate(_ASCII_PUNCT)
+    return _PUNCT_RE.sub('', text)
+
+
+def similarity_scores(texts, targets):
+    """
+    Similarity ratios (0-1) between transcriptions and their target phrases,
+    scored pairwise in one native rapidfuzz pass.
+
+    Both sides are lowercased and stripped first; a pair with an empty side
+    scores 0. Whole runs and GUI rescoring use it; similarity() applies the
+    same rule to a single pair.
+
+    Returns:
+        A float64 array with one score per pair.
+    """
+    t1 = [(text or '').lower().strip() for text in texts]
+    t2 = [(target or '').lower().strip() for target in targets]
+    if not t1:
+        return np.zeros(0)
+    # Single-threaded: each pair is microseconds, so worker threads only add overhead
+    scores = process.cpdist(t1, t2, scorer=Indel.normalized_similarity,
+                            dtype=np.float64, workers=1)
+    empty = np.array([not (a and b) for a, b in zip(t1, t2)])
+    return np.where(empty, 0.0, scores)
+
+
+@lru_cache(maxsize=4096)
+def similarity(text, target):
+    """
+    Similarity ratio (0-1) of a single pair, with the same rule as
+    similarity_scores.
+
+    The GUI rescores edits with it, so repeated pairs come from the cache.
+    """
+    t1 = text.lower().strip()
+    t2 = target.lower().strip()
+    if not (t1 and t2):
+        return 0.0
+    return Indel.normalized_similarity(t1, t2)
+
+
+def score_results(results):
+    """Sets similarity_score on every result row."""
+    scores = similarity_scores([result['transcribed_text'] for result in results],
+                               [result['target_phrase'] for result in results])
+    for result, score in zip(results, scores):
+        result['similarity_score'] = float(score)
+
+
+def file_signature(path):
+    """(mtime in ns, size) of a file; changes whenever the file is rewritten."""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+# Files per batched encoder pass; 8 log-mel inputs are ~8 MB of float32
+BATCH_SIZE = 8
+
+
+def load_whisper_model(name="base"):
+    """Loads a Whisper model (on the GPU when there is one)."""
+    import whisper
+    # Weights stay float32: the layers cast them to fp16 inputs on CUDA, and
+    # LayerNorm needs float32 parameters
+    return whisper.load_model(name)
+
+
+def audio_cache_name(path):
+    """
+    Name of the decoded-audio cache entry for a file: a hash of its absolute
+    path, mtime and size, so any change to the file means a new entry.
+    """
+    mtime_ns, size = file_signature(path)
+    key = f"{os.path.abspath(path)}|{mtime_ns}|{size}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy"
+
+
+def prune_audio_cache(cache_dir, keep):
+    """Removes cache entries not named in keep (changed or no longer used files)."""
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return # No cache yet
+    for name in names:
+        if name.endswith(".npy") and name not in keep:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def load_audio(path, cache_dir=None):
+    """
+    Decodes an audio file to 16 kHz mono with ffmpeg.
+
+    With a cache_dir, the decoded samples are also kept there as .npy (see
+    audio_cache_name) and reused while the file is unchanged, so re-runs
+    skip ffmpeg.
+
+    Returns:
+        An (audio, error) tuple; error is None on success.
+    """
+    import whisper
+    cache_path = None
+    if cache_dir:
+        try:
+            cache_path = os.path.join(cache_dir, audio_cache_name(path))
+            return np.load(cache_path), None
+        except (OSError, ValueError):
+            pass # Not cached yet (or unreadable): decode below
+
+    try:
+        audio = whisper.load_audio(path)
+    except Exception as e:
+        return None, e
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, audio)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass # The cache is optional
+    return audio, None
+
+
+def transcribe_batch(model, loaded, prompts):
+    """
+    Transcribes several decoded clips with a single batched Whisper encoder pass.
+
+    Each file is then decoded with its own prompt. Clips whose greedy decode
+    looks unreliable (or that are longer than Whisper's 30s window) are
+    re-run through model.transcribe, which adds temperature fallback,
+    no-speech detection and long-form windowing.
+
+    Args:
+        model: Loaded Whisper model.
+        loaded: (audio, error) tuples as returned by load_audio.
+        prompts: Initial prompt (target phrase) for each file.
+
+    Returns:
+        A list of (text, error) tuples in input order; error is None on success.
+    """
+    import torch
+    import whisper
+
+    # Half precision only where it is supported and fast (CUDA)
+    fp16 = model.device.type == "cuda"
+    outputs = [(None, None)] * len(loaded)
+
+    audios, mels, positions = [], [], []
+    for j, (audio, error) in enumerate(loaded):
+        if error is not None:
+            outputs[j] = ("", error)
+            continue
+        try:
+            mels.append(whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels))
+        except Exception as e:
+            outputs[j] = ("", e)
+            continue
+        audios.append(audio)
+        positions.append(j)
+
+    if not positions:
+        return outputs
+
+    try:
+        mel_batch = torch.stack(mels).to(model.device)
+        with torch.no_grad():
+            features = model.embed_audio(mel_batch.half() if fp16 else mel_batch)
+    except Exception:
+        # The batched pass failed (e.g. out of GPU memory): transcribe each file on
+        # its own, so errors stay per trial
+        for audio, j in zip(audios, positions):
+            try:
+                outputs[j] = (model.transcribe(audio, initial_prompt=prompts[j], fp16=fp16)["text"], None)
+            except Exception as e:
+                outputs[j] = ("", e)
+        return outputs
+
+    for audio, mel_features, j in zip(audios, features, positions):
+        try:
+            result = model.decode(mel_features, whisper.DecodingOptions(prompt=prompts[j] or None, fp16=fp16))
+            # Same thresholds transcribe() uses to decide on a fallback
+            if (len(audio) > whisper.audio.N_SAMPLES
+                    or result.compression_ratio > 2.4 or result.avg_logprob < -1.0):
+                text = model.transcribe(audio, initial_prompt=prompts[j], fp16=fp16)["text"]
+            else:
+                text = result.text
+            outputs[j] = (text, None)
+        except Exception as e:
+            outputs[j] = ("", e)
+
+    return outputs
+
+
+# Feather schema metadata key holding the signature of the CSV a snapshot copies
+_SNAPSHOT_KEY = b"audiocheck_csv"
+
+
+def get_snapshot_path(csv_path):
+    """Typed binary copy of a results CSV (same name, .feather)."""
+    return os.path.splitext(csv_path)[0] + ".feather"
+
+
+def write_feather_snapshot(df, csv_path):
+    """Writes df as the Feather snapshot of csv_path, tagged with the CSV's current signature."""
+    import pyarrow as pa
+    from pyarrow import feather
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_SNAPSHOT_KEY] = json.dumps(file_signature(csv_path)).encode('utf-8')
+    feather.write_feather(table.replace_schema_metadata(metadata), get_snapshot_path(csv_path))
+
+
+def read_feather_snapshot(csv_path, signature):
+    """
+    Reads the Feather snapshot of csv_path if it was written for exactly this
+    CSV (same file signature); returns None otherwise.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    snapshot_path = get_snapshot_path(csv_path)
+    try:
+        with pa.memory_map(snapshot_path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+        if json.loads(metadata.get(_SNAPSHOT_KEY, b"null")) != list(signature):
+            return None
+        return pd.read_feather(snapshot_path)
+    except (OSError, ValueError, pa.ArrowException):
+        return None # Missing or unreadable: the CSV has everything
+
+
+def write_snapshot(results, fieldnames, csv_path):
+    """
+    Writes a Feather copy of the results next to the CSV (same name, .feather).
+
+    The GUI loads it instead of parsing the CSV while the CSV is unchanged.
+    Values are typed the way pandas would read them back from the CSV.
+    """
+    try:
+        import pandas as pd
+        df = pd.DataFrame(results, columns=fieldnames).replace('', None)
+        for col in ('block', 'trial', 'audio_mtime'):
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except ValueError:
+                pass # Non-numeric labels stay text, as in the CSV
+        write_feather_snapshot(df, csv_path)
+    except Exception as e:
+        print(f"Could not write Feather snapshot (the CSV is complete): {e}")
+
+
+def load_previous_results(output_csv_path):
+    """
+    Reads an earlier results CSV, keyed by audio filename, for incremental runs.
+
+    Only rows that recorded the audio file's mtime can be reused; anything
+    unreadable just means everything is transcribed again.
+    """
+    previous = {}
+    try:
+        with open(output_csv_path, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if row.get('audio_mtime') and not row.get('error'):
+                    previous[row.get('audio_filename', '')] = row
+    except (OSError, csv.Error, UnicodeDecodeError):
+        pass
+    return previous
+
+
+def transcribe_and_compare(participant_id, data_dir="data", status_callback=None, model=None, full=False,
+                           load_model=None):
     """
     Reads data csv for a participant, finds audio files, transcribes them, 
     and compares with the target phrase.
+
+    Trials whose audio file (same mtime) and target phrase are unchanged since
+    the last run reuse their earlier transcription unless full is True.
     
     Args:
         participant_id: ID of the participant.
         data_dir: Root data directory.
         status_callback: Optional function (msg) -> None to report progress.
+        model: Optional already-loaded Whisper model. Loaded here if None.
+        full: Transcribe every trial, ignoring earlier results.
+        load_model: Optional function (name) -> model used to load it, once the
+            inputs have been checked (defaults to load_whisper_model).
     """
     
     def log(msg):
@@ -33,6 +331,8 @@ def transcribe_and_compare(participant_id, data_dir="data", status_callback=None
     # Output file
     output_csv_filename = f"{participant_id}_transcription_results.csv"
     output_csv_path = os.path.join(participant_data_dir, output_csv_filename)
+    # Decoded audio kept between runs (safe to delete)
+    audio_cache_dir = os.path.join(participant_data_dir, ".audio_cache")
 
     import shutil
     
@@ -53,20 +353,21 @@ def transcribe_and_compare(participant_id, data_dir="data", status_callback=None
             
         return False
 
-    # Initialize Whisper Model
-    log("Loading Whisper model (base)... This may take a moment on first run.")
-    try:
-        import whisper
-        # Load model once
-        model = whisper.load_model("base")
-    except ImportError:
-        log("Error: 'openai-whisper' not installed. Please install it via pip.")
-        return False
-    except Exception as e:
-        log(f"Error loading Whisper model: {e}")
-        return False
+    # Initialize Whisper Model (the GUI passes in its cached loader)
+    if model is None:
+        log("Loading Whisper model (base)... This may take a moment on first run.")
+        try:
+            # Load model once
+            model = (load_model or load_whisper_model)("base")
+        except ImportError:
+            log("Error: 'openai-whisper' not installed. Please install it via pip.")
+            return False
+        except Exception as e:
+            log(f"Error loading Whisper model: {e}")
+            return False
 
     results = []
+    previous = {} if full else load_previous_results(output_csv_path)
 
     log(f"Processing participant {participant_id}...")
     log(f"Reading from: {csv_path}")
@@ -77,6 +378,10 @@ def transcribe_and_compare(participant_id, data_dir="data", status_callback=None
             rows = list(reader)
             total_rows = len(rows)
 
+            # Pass 1: resolve audio files; missing ones are reported right away
+            pending = [] # (row position, audio path) of files to transcribe
+            cache_names = set() # Decoded-audio cache entries still in use
+            reused = 0
             for i, row in enumerate(rows):
                 audio_rel_path = row.get('audio_filename', '').replace('\\', '/') # Fix windows paths
                 target_phrase = row.get('phrase', '')
@@ -120,60 +425,96 @@ def transcribe_and_compare(participant_id, data_dir="data", status_callback=None
                     # Fallback to original for error reporting
                     audio_file_path = audio_rel_path
                 
-                transcribed_text = ""
-                similarity_score = 0.0
-                error_msg = ""
-                
-                log(f"[{i+1}/{total_rows}] Block {block}, Trial {trial}: {audio_file_path}")
-
-                if os.path.exists(audio_file_path):
-                    try:
-                        # Transcribe with Whisper
-                        # fp16=False prevents warnings on CPU (mps/cuda autofallback handled by whisper usually)
-                        result = model.transcribe(audio_file_path, 
-                                                  initial_prompt=target_phrase,
-                                                  fp16=False)
-                        # Normalize: lower case and keep ONLY alphanumeric + spaces (regex)
-                        # This handles unicode punctuation (curly quotes etc) by exclusion
-                        raw_text = result["text"].lower()
-                        transcribed_text = re.sub(r'[^\w\s]', '', raw_text)
-                        log(f"    -> Transcribed: '{transcribed_text}'")
-                    except Exception as e:
-                        error_msg = f"Error processing audio file: {e}"
-                        log(f"    -> Error: {error_msg}")
-                else:
-                    error_msg = "Audio file not found"
-                    log(f"    -> Error: {error_msg}")
-
-                # Comparison Logic
-                if transcribed_text and target_phrase:
-                    # Normalize texts (lowercase, strip, remove punctuation if needed)
-                    t1 = transcribed_text.lower().strip()
-                    t2 = target_phrase.lower().strip()
-                    similarity_score = difflib.SequenceMatcher(None, t1, t2).ratio()
-                
                 results.append({
                     'block': block,
                     'trial': trial,
                     'audio_filename': audio_rel_path,
                     'target_phrase': target_phrase,
-                    'transcribed_text': transcribed_text,
-                    'similarity_score': similarity_score,
-                    'error': error_msg
+                    'transcribed_text': "",
+                    'original_transcription': "",
+                    'similarity_score': 0.0,
+                    'error': "",
+                    'audio_mtime': ""
                 })
 
+                if os.path.exists(audio_file_path):
+                    audio_mtime = os.path.getmtime(audio_file_path)
+                    cache_names.add(audio_cache_name(audio_file_path))
+                    results[i]['audio_mtime'] = audio_mtime
+                    cached = previous.get(audio_rel_path)
+                    try:
+                        unchanged = (cached is not None and float(cached['audio_mtime']) == audio_mtime
+                                     and cached.get('target_phrase') == target_phrase)
+                    except ValueError:
+                        unchanged = False
+                    if unchanged:
+                        # Reuse the machine transcription, not any later manual edit
+                        text = cached.get('original_transcription', cached.get('transcribed_text')) or ""
+                        results[i]['transcribed_text'] = text
+                        results[i]['original_transcription'] = text
+                        reused += 1
+                    else:
+                        pending.append((i, audio_file_path))
+                else:
+                    log(f"[{i+1}/{total_rows}] Block {block}, Trial {trial}: {audio_file_path}")
+                    results[i]['error'] = "Audio file not found"
+                    log(f"    -> Error: {results[i]['error']}")
+
+            if reused:
+                log(f"Reusing {reused} unchanged transcriptions; {len(pending)} to transcribe.")
+
+            # Pass 2: transcribe in batches sharing one encoder pass
+            # ffmpeg decoding runs in worker threads one batch ahead; the model stays on
+            # this thread because its decoder keeps per-call state on the module
+            batches = [pending[start:start + BATCH_SIZE] for start in range(0, len(pending), BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=min(BATCH_SIZE, os.cpu_count() or 1)) as pool:
+                def submit_loads(batch):
+                    return [pool.submit(load_audio, path, audio_cache_dir) for _, path in batch]
+
+                next_loads = submit_loads(batches[0]) if batches else []
+                for k, batch in enumerate(batches):
+                    loads = next_loads
+                    if k + 1 < len(batches):
+                        next_loads = submit_loads(batches[k + 1])
+                    outputs = transcribe_batch(model,
+                                               [future.result() for future in loads],
+                                               [results[i]['target_phrase'] for i, _ in batch])
+
+                    for (i, audio_file_path), (raw_text, error) in zip(batch, outputs):
+                        result = results[i]
+                        log(f"[{i+1}/{total_rows}] Block {result['block']}, Trial {result['trial']}: {audio_file_path}")
+                        if error:
+                            result['error'] = f"Error processing audio file: {error}"
+                            log(f"    -> Error: {result['error']}")
+                            continue
+                        # Normalize: lower case and keep ONLY alphanumeric + spaces
+                        result['transcribed_text'] = strip_punctuation(raw_text.lower())
+                        # Kept as-is while the GUI edits transcribed_text (change tracking)
+                        result['original_transcription'] = result['transcribed_text']
+                        log(f"    -> Transcribed: '{result['transcribed_text']}'")
+
+            prune_audio_cache(audio_cache_dir, cache_names)
+
+            # Comparison Logic (the same score the GUI uses for edits), once all text is in
+            score_results(results)
+
     except Exception as e:
         log(f"Critical Error reading CSV: {e}")
         return False
 
     # Write results
     if results:
-        fieldnames = ['block', 'trial', 'audio_filename', 'target_phrase', 'transcribed_text', 'similarity_score', 'error']
+        fieldnames = ['block', 'trial', 'audio_filename', 'target_phrase', 'transcribed_text', 'similarity_score', 'error', 'original_transcription', 'audio_mtime']
         try:
             with open(output_csv_path, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.DictWriter(f, fieldnames=fieldnames)
                 writer.writeheader()
                 writer.writerows(results)
+            # After the CSV, so the snapshot records its final signature
+            write_snapshot(results, fieldnames, output_csv_path)
+            # GUI edit logs refer to the rows just replaced (manual edits are not kept)
+            for p in glob.glob(glob.escape(os.path.join(participant_data_dir, f"{participant_id}_edits.jsonl")) + "*"):
+                os.remove(p)
             log(f"Done! Results saved to: {output_csv_path}")
             return True
         except Exception as e:
@@ -187,6 +528,7 @@ def transcribe_and_compare(participant_id, data_dir="data", status_callback=None
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Transcribe audio files and compare with target text.")
     parser.add_argument("participant_id", help="The ID of the participant (folder name in data directory)")
+    parser.add_argument("--full", action="store_true", help="Transcribe every trial, even ones unchanged since the last run")
     
     # Check if arguments are passed, if not prompt user
     if len(os.sys.argv) == 1:
@@ -195,4 +537,4 @@ if __name__ == "__main__":
         transcribe_and_compare(p_id)
     else:
         args = parser.parse_args()
-        transcribe_and_compare(args.participant_id)
+        transcribe_and_compare(args.participant_id, full=args.full)